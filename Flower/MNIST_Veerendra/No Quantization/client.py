@@ -1,10 +1,10 @@
 import torch
 from torchvision import transforms, datasets
 from torch import nn, optim
-from torch.utils.data import random_split, DataLoader
+from torch.utils.data import Subset, DataLoader
 from tqdm import tqdm
 import flwr as fl
-from collections import OrderedDict
+import numpy as np
 
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -30,12 +30,17 @@ def load_dataset():
     train_size = len(train_set)//10
     val_size = len(val_set)//10
 
-    train_set = random_split(
-        train_set, [train_size, len(train_set)-train_size])[0]
-    val_set = random_split(val_set, [val_size, len(val_set)-val_size])[0]
+    train_set = Subset(
+        train_set, torch.randperm(len(train_set))[:train_size].tolist())
+    val_set = Subset(val_set, torch.randperm(len(val_set))[:val_size].tolist())
 
-    train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=True)
-    val_loader = DataLoader(val_set, batch_size=BATCH_SIZE, shuffle=False)
+    # pinned batches let the copies to the gpu overlap with compute.
+    train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=True,
+                              num_workers=2, persistent_workers=True,
+                              pin_memory=DEVICE.type == 'cuda')
+    val_loader = DataLoader(val_set, batch_size=BATCH_SIZE, shuffle=False,
+                            num_workers=2, persistent_workers=True,
+                            pin_memory=DEVICE.type == 'cuda')
 
     return train_loader, val_loader
 
@@ -45,17 +50,17 @@ class LeNet5(nn.Module):
         super(LeNet5, self).__init__()
         self.features = nn.Sequential(
             nn.Conv2d(1, 6, kernel_size=5, stride=1),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=2),
             nn.Conv2d(6, 16, kernel_size=5, stride=1),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=2)
         )
         self.classifier = nn.Sequential(
             nn.Linear(16*4*4, 120),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.Linear(120, 84),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.Linear(84, num_classes)
         )
 
@@ -72,10 +77,14 @@ def train(model, trainloader, epochs):
     optimizer = optim.SGD(model.parameters(), lr=0.01)
     for epoch in range(epochs):
         for X, y in tqdm(trainloader):
-            X, y = X.to(DEVICE), y.to(DEVICE)
+            X = X.to(DEVICE, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(DEVICE, non_blocking=True)
             optimizer.zero_grad()
-            yhat = model(X)
-            loss = loss_fn(yhat, y)
+            # bf16 has the range of fp32, so no grad scaler is needed.
+            with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16,
+                                enabled=DEVICE.type == 'cuda'):
+                yhat = model(X)
+                loss = loss_fn(yhat, y)
             loss.backward()
             optimizer.step()
 
@@ -83,18 +92,20 @@ def train(model, trainloader, epochs):
 def val(model, valloader):
     model.eval()
     loss_fn = nn.CrossEntropyLoss()
-    crct, loss = 0, 0.0
-    with torch.no_grad():
+    # counting on the device, so there is a single sync at the end.
+    crct, loss = torch.zeros((), dtype=torch.long, device=DEVICE), 0.0
+    with torch.inference_mode():
         for X, y in tqdm(valloader):
-            X, y = X.to(DEVICE), y.to(DEVICE)
+            X = X.to(DEVICE, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(DEVICE, non_blocking=True)
             yhat = model(X)
             loss += loss_fn(yhat, y)
-            crct += (torch.max(yhat.data, 1)[1] == y).sum().item()
-    acc = crct / len(valloader.dataset)
+            crct += (yhat.argmax(1) == y).sum()
+    acc = crct.item() / len(valloader.dataset)
     return loss, acc
 
 
-model = LeNet5().to(DEVICE)
+model = LeNet5().to(DEVICE, memory_format=torch.channels_last)
 trainloader, valloader = load_dataset()
 
 
@@ -110,11 +121,12 @@ class FlowerClient(fl.client.NumPyClient):
         return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
 
     def set_parameters(self, parameters, config):
-        param_dict = zip(self.model.state_dict().keys(), parameters)
-        state_dict = OrderedDict({
-            k: torch.tensor(v) for k, v in param_dict
-        })
-        self.model.load_state_dict(state_dict, strict=True)
+        # loading all the layers with a single host to device copy.
+        flat_params = torch.from_numpy(np.concatenate(
+            [p.ravel() for p in parameters])).to(DEVICE, torch.float32)
+        nn.utils.vector_to_parameters(flat_params, self.model.parameters())
+        # vector_to_parameters leaves the conv weights contiguous again.
+        self.model.to(memory_format=torch.channels_last)
 
     def fit(self, parameters, config):
         local_epochs = config["local_epochs"]
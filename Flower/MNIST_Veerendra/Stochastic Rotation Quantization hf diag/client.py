@@ -1,10 +1,10 @@
 import torch
 from torchvision import transforms, datasets
 from torch import nn, optim
-from torch.utils.data import random_split, DataLoader
+from torch.utils.data import Subset, DataLoader
 from tqdm import tqdm
 import flwr as fl
-from collections import OrderedDict
+import numpy as np
 
 
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -31,12 +31,17 @@ def load_dataset():
     train_size = len(train_set)//10
     val_size = len(val_set)//10
 
-    train_set = random_split(
-        train_set, [train_size, len(train_set)-train_size])[0]
-    val_set = random_split(val_set, [val_size, len(val_set)-val_size])[0]
+    train_set = Subset(
+        train_set, torch.randperm(len(train_set))[:train_size].tolist())
+    val_set = Subset(val_set, torch.randperm(len(val_set))[:val_size].tolist())
 
-    train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=True)
-    val_loader = DataLoader(val_set, batch_size=BATCH_SIZE, shuffle=False)
+    # pinned batches let the copies to the gpu overlap with compute.
+    train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=True,
+                              num_workers=2, persistent_workers=True,
+                              pin_memory=DEVICE.type == 'cuda')
+    val_loader = DataLoader(val_set, batch_size=BATCH_SIZE, shuffle=False,
+                            num_workers=2, persistent_workers=True,
+                            pin_memory=DEVICE.type == 'cuda')
 
     return train_loader, val_loader
 
@@ -46,17 +51,17 @@ class LeNet5(nn.Module):
         super(LeNet5, self).__init__()
         self.features = nn.Sequential(
             nn.Conv2d(1, 6, kernel_size=5, stride=1),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=2),
             nn.Conv2d(6, 16, kernel_size=5, stride=1),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=2)
         )
         self.classifier = nn.Sequential(
             nn.Linear(16*4*4, 120),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.Linear(120, 84),
-            nn.Tanh(),
+            nn.ReLU(inplace=True),
             nn.Linear(84, num_classes)
         )
 
@@ -73,10 +78,14 @@ def train(model, trainloader, epochs):
     optimizer = optim.SGD(model.parameters(), lr=0.01)
     for epoch in range(epochs):
         for X, y in tqdm(trainloader):
-            X, y = X.to(DEVICE), y.to(DEVICE)
+            X = X.to(DEVICE, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(DEVICE, non_blocking=True)
             optimizer.zero_grad()
-            yhat = model(X)
-            loss = loss_fn(yhat, y)
+            # bf16 has the range of fp32, so no grad scaler is needed.
+            with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16,
+                                enabled=DEVICE.type == 'cuda'):
+                yhat = model(X)
+                loss = loss_fn(yhat, y)
             loss.backward()
             optimizer.step()
 
@@ -84,73 +93,79 @@ def train(model, trainloader, epochs):
 def val(model, valloader):
     model.eval()
     loss_fn = nn.CrossEntropyLoss()
-    crct, loss = 0, 0.0
-    with torch.no_grad():
+    # counting on the device, so there is a single sync at the end.
+    crct, loss = torch.zeros((), dtype=torch.long, device=DEVICE), 0.0
+    with torch.inference_mode():
         for X, y in tqdm(valloader):
-            X, y = X.to(DEVICE), y.to(DEVICE)
+            X = X.to(DEVICE, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(DEVICE, non_blocking=True)
             yhat = model(X)
             loss += loss_fn(yhat, y)
-            crct += (torch.max(yhat.data, 1)[1] == y).sum().item()
-    acc = crct / len(valloader.dataset)
+            crct += (yhat.argmax(1) == y).sum()
+    acc = crct.item() / len(valloader.dataset)
     return loss, acc
 
 
-model = LeNet5().to(DEVICE)
+model = LeNet5().to(DEVICE, memory_format=torch.channels_last)
 trainloader, valloader = load_dataset()
 
 
-def qunatization(params):
-    # preprocess:
+# side stream for drawing the noise of the bernoulli samples.
+RNG_STREAM = torch.cuda.Stream() if DEVICE.type == 'cuda' else None
+
+
+def draw_noise(noise):
+    # filling the noise buffer on the side stream, so that it overlaps with the
+    # work queued on the main stream until qunatization waits for it. the last
+    # read of the buffer ended with the host copy of the previous round.
+    if RNG_STREAM is None:
+        return noise.uniform_()
+    with torch.cuda.stream(RNG_STREAM):
+        return noise.uniform_()
+
+
+# compiled so that the elementwise encoding steps get fused together.
+@torch.compile
+def encode(params, noise):
+    # preprocess: rotating all the blocks, the zero padded last one included,
+    # with a single matmul.
     params = torch.mm(params, R.T)
     # maxs, mins for each block and thus finding si
     mins = torch.min(params, axis=1, keepdims=True).values
     maxs = torch.max(params, axis=1, keepdims=True).values
     si = maxs - mins
 
-    # quantization levels for each block
-    Bi = mins + si*(torch.arange(K)/(K-1))
+    # finding B(r) as per paper, the levels are evenly spaced so the index is
+    # just the floor of the distance from the min in steps.
+    step = torch.clamp(si/(K-1), min=torch.finfo(si.dtype).tiny)
+    ids = torch.clamp(((params-mins)/step).floor(), 0, K-1).long()
 
-    # finding B(r) as per paper.
-    ids = torch.searchsorted(Bi, params, side='right')-1
+    # converting indices into quantization values, B(r) = min + r*step.
+    Br = mins + ids*step
 
-    # making them into (B(r+1), B(r))
-    points = torch.cat([
-        torch.unsqueeze(ids, -1),
-        torch.unsqueeze((ids+1), -1)
-    ], axis=-1)
+    # finding probability for each parameter. for the max element B(r) is the
+    # max itself so its probability is 0.
+    probs = ((params-Br)/step).clamp(0, 1)
 
-    # marking B(r) = B(r+1) for max in each block.
-    points[points == K] = K-1
+    # returns 1s, 0s based on paper, 1 with probability probs.
+    encs = (noise < probs).long()
 
-    # converting indices into quantization values.
-    Brs = Bi[torch.arange(Bi.shape[0]).unsqueeze(1),
-             points.view(Bi.shape[0], -1)].view(points.shape)
+    # level of B(r+1) for 1s and of B(r) for 0s, the max of each block stays
+    # on the top level.
+    levels = torch.clamp(ids + encs, max=K-1).to(torch.uint8)
 
-    # finding probability for each parameter. probability of max element is 0.
-    probs = torch.where(
-        Brs[..., 1] != Brs[..., 0],
-        (params-Brs[..., 0])/(Brs[..., 1]-Brs[..., 0]),
-        0)
+    return levels, mins, step
 
-    # returns 1s, 0s based on paper.
-    encs = torch.bernoulli(probs)
 
-    # replacing 1s with B(r+1) and 0s with B(r) and flattenning the whole array.
-    dec = torch.where(
-        encs == 1,
-        Brs[..., 1],
-        Brs[..., 0]
-    )
+def qunatization(params, noise):
+    # waiting for the noise before it gets used on the main stream.
+    if RNG_STREAM is not None:
+        torch.cuda.current_stream().wait_stream(RNG_STREAM)
 
-    # reconstructing the parameters into their corresponding shapes.
-    dec = torch.mm(params, torch.linalg.inv(R).T).flatten()
-    revert = []
-    ptr = 0
-    for layer in model.parameters():
-        size = layer.numel()
-        revert.append(dec[ptr: ptr+size].reshape(layer.shape).cpu().numpy())
-        ptr += size
-    return revert
+    # the server maps the levels back to values with the min and step of
+    # every block, so only a byte per parameter goes over the wire.
+    levels, mins, step = encode(params, noise)
+    return [levels.cpu().numpy(), mins.cpu().numpy(), step.cpu().numpy()]
 
 
 class FlowerClient(fl.client.NumPyClient):
@@ -160,24 +175,49 @@ class FlowerClient(fl.client.NumPyClient):
         self.trainloader = trainloader
         self.valloader = valloader
 
+        # offset, size and shape of every layer in the flattened parameters.
+        self.layout = []
+        self.num_params = 0
+        for layer in model.parameters():
+            self.layout.append(
+                (self.num_params, layer.numel(), tuple(layer.shape)))
+            self.num_params += layer.numel()
+
+        # buffers reused every round, splitting parameters into 1024 batches
+        # each, the zero padding up to the next multiple of 1024 is set here.
+        num_blocks = -(-self.num_params // 1024)
+        self.params_buf = torch.zeros((num_blocks, 1024), device=DEVICE)
+        self.noise_buf = torch.empty((num_blocks, 1024), device=DEVICE)
+
     def get_parameters(self, config):
         print("[SENDING PARAMETERS TO SERVER]")
 
-        # flattening the parameters
-        flat_params = nn.utils.parameters_to_vector(
-            self.model.parameters()).detach()
+        # copying to host once and splitting it into the layers.
+        flat_params = torch.cat([
+            p.detach().reshape(-1) for p in self.model.parameters()]).cpu().numpy()
+        return [flat_params[ptr: ptr+size].reshape(shape)
+                for ptr, size, shape in self.layout]
+
+    def get_quantized_parameters(self, config):
+        print("[SENDING QUANTIZED PARAMETERS TO SERVER]")
+
+        # drawing the bernoulli noise first so it overlaps with the flattening.
+        noise = draw_noise(self.noise_buf)
 
-        # splitting parameters into 1024 batches each
-        params = torch.cat([flat_params,
-                            torch.zeros(1024 - (flat_params.numel() % 1024))]).view(-1, 1024)
-        return qunatization(params)
+        # flattening the parameters into the blocks buffer, reshape instead of
+        # the view that parameters_to_vector does as the conv weights are
+        # channels_last.
+        torch.cat([p.detach().reshape(-1) for p in self.model.parameters()],
+                  out=self.params_buf.view(-1)[:self.num_params])
+        return qunatization(self.params_buf, noise)
 
     def set_parameters(self, parameters, config):
-        param_dict = zip(self.model.state_dict().keys(), parameters)
-        state_dict = OrderedDict({
-            k: torch.tensor(v) for k, v in param_dict
-        })
-        self.model.load_state_dict(state_dict, strict=True)
+        # loading all the layers with a single host to device copy.
+        flat_params = torch.from_numpy(np.concatenate(
+            [p.ravel() for p in parameters])).to(DEVICE, torch.float32)
+        nn.utils.vector_to_parameters(flat_params, self.model.parameters())
+        # vector_to_parameters leaves the conv weights contiguous again.
+        self.model.to(memory_format=torch.channels_last)
 
     def fit(self, parameters, config):
         local_epochs = config["local_epochs"]
@@ -187,7 +227,8 @@ class FlowerClient(fl.client.NumPyClient):
 
         self.set_parameters(parameters, config)
         train(self.model, self.trainloader, epochs=local_epochs)
-        return self.get_parameters(config), len(self.trainloader.dataset), {}
+        return (self.get_quantized_parameters(config),
+                len(self.trainloader.dataset), {})
 
     def evaluate(self, parameters, config):
         print("[EVAL, RECEIVED PARAMETERS FROM SERVER]")
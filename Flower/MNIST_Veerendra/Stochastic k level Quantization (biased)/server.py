@@ -1,4 +1,6 @@
 import flwr as fl
+import numpy as np
+from flwr.common import ndarrays_to_parameters, parameters_to_ndarrays
 from flwr.server.strategy import FedAvg
 
 
@@ -18,7 +20,38 @@ def fit_config(server_round):
     return config
 
 
-strategy = FedAvg(
+def dequantize(levels, mins, step, shapes):
+    # mapping the levels back to values.
+    params = (mins + step*levels).flatten()
+
+    # reconstructing the parameters into their corresponding shapes.
+    revert = []
+    ptr = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        revert.append(params[ptr: ptr+size].reshape(shape))
+        ptr += size
+    return revert
+
+
+class QuantizedFedAvg(FedAvg):
+    # clients send their parameters back as uint8 levels along with the min
+    # and step of every 1024 block, they get dequantized before averaging.
+
+    def configure_fit(self, server_round, parameters, client_manager):
+        # the global parameters sent out give the shapes of the layers.
+        self.shapes = [p.shape for p in parameters_to_ndarrays(parameters)]
+        return super().configure_fit(server_round, parameters, client_manager)
+
+    def aggregate_fit(self, server_round, results, failures):
+        for _, fit_res in results:
+            levels, mins, step = parameters_to_ndarrays(fit_res.parameters)
+            fit_res.parameters = ndarrays_to_parameters(
+                dequantize(levels, mins, step, self.shapes))
+        return super().aggregate_fit(server_round, results, failures)
+
+
+strategy = QuantizedFedAvg(
     min_available_clients=10,
     min_fit_clients=5,
     min_evaluate_clients=3,